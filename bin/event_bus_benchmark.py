@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+import gc
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), '..')))
+
+from smpy.XyzStateMachine import XyzStateMachine, XyzState  # noqa: E402
+from smpy.event_bus import EventBus  # noqa: E402
+
+
+MACHINES = 5000
+PUBLISHES = 20
+RUNS = 9
+
+
+def create_state_machines():
+    """
+    Machines that toggle between DEFAULT and RUNNING on every data, with
+    a listener on the transition, as a typical subscriber does.
+    """
+    state_machines = []
+
+    for i in range(MACHINES):
+        state_machine = XyzStateMachine()
+        state_machine.on_data(XyzState.DEFAULT, lambda data: XyzState.RUNNING)
+        state_machine.on_data(XyzState.RUNNING, lambda data: XyzState.DEFAULT)
+        state_machine.after_enter(XyzState.RUNNING, lambda ev: None)
+        state_machines.append(state_machine)
+
+    return state_machines
+
+
+def loop():
+    state_machines = create_state_machines()
+
+    def publish(data):
+        for state_machine in state_machines:
+            state_machine.send_data(data)
+
+    return publish
+
+
+def event_bus():
+    state_machines = create_state_machines()
+    bus = EventBus()
+
+    for state_machine in state_machines:
+        bus.subscribe("topic", state_machine)
+
+    return lambda data: bus.publish("topic", data)
+
+
+def elapsed(create_publisher):
+    publish = create_publisher()
+    start = time.perf_counter()
+
+    for i in range(PUBLISHES):
+        publish(i)
+
+    return time.perf_counter() - start
+
+
+def calls_per_machine(create_publisher):
+    """
+    The Python and builtin calls done for each machine by a publish. Unlike
+    the timings, it's not affected by the other processes on the machine.
+    """
+    publish = create_publisher()
+    calls = [0]
+
+    def count_calls(frame, event, arg):
+        if event == 'call' or event == 'c_call':
+            calls[0] += 1
+
+    sys.setprofile(count_calls)
+    publish(0)
+    sys.setprofile(None)
+
+    return calls[0] / MACHINES
+
+
+def main():
+    benchmarks = [("send_data loop", loop), ("EventBus.publish", event_bus)]
+    timings = dict((name, []) for name, benchmark in benchmarks)
+
+    # interleaved, so a noisy neighbour slows down both of them, and without
+    # the garbage collector, as timeit does.
+    gc.disable()
+
+    for i in range(RUNS):
+        for name, benchmark in benchmarks:
+            timings[name].append(elapsed(benchmark))
+            gc.collect()
+
+    for name, benchmark in benchmarks:
+        runs = sorted(timings[name])
+
+        print("%s: min %.3fs, median %.3fs, %.1f calls per machine (%d machines, %d publishes, %d runs)" % (
+            name, runs[0], runs[len(runs) // 2], calls_per_machine(benchmark), MACHINES, PUBLISHES, RUNS))
+
+
+if __name__ == '__main__':
+    main()
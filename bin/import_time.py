@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+import os
+import re
+import subprocess
+import sys
+
+
+PROJECT_DIR = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
+IMPORT_TIME_RE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$")
+RUNS = 20
+# measure the imports from the bytecode cache, as installed packages do,
+# not the compilation of the sources.
+ENV = {k: v for k, v in os.environ.items() if k != 'PYTHONDONTWRITEBYTECODE'}
+
+
+def import_time(module_name: str):
+    """
+    Imports the module in a fresh interpreter with `-X importtime`, and
+    returns the cumulative import time in microseconds, together with the
+    top level modules that were pulled in by the import.
+    """
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import %s" % module_name],
+        cwd=PROJECT_DIR,
+        env=ENV,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True).stderr
+
+    total = 0
+    imported = []
+
+    # children are reported before their parent, so we collect the direct
+    # children of every top level import until we reach our module.
+    for line in output.splitlines():
+        m = IMPORT_TIME_RE.match(line)
+
+        if not m:
+            continue
+
+        depth = len(m.group(3))
+
+        if depth == 1 and m.group(4) == module_name:
+            total = int(m.group(2))
+            break
+
+        if depth == 1:
+            imported = []
+        elif depth == 3:
+            imported.append(m.group(4))
+
+    return total, imported
+
+
+def main(module_names):
+    for module_name in module_names:
+        timings = []
+        imported = []
+
+        import_time(module_name)  # writes the bytecode cache
+
+        for i in range(RUNS):
+            total, imported = import_time(module_name)
+            timings.append(total)
+
+        timings.sort()
+
+        print("%s: min %dus, median %dus (%d runs)" % (
+            module_name, timings[0], timings[len(timings) // 2], RUNS))
+        print("  imports: %s" % ", ".join(imported))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:] or ['smpy.XyzStateMachine'])
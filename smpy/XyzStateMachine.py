@@ -1,6 +1,8 @@
 from enum import Enum
-from typing import Any, Dict, Optional, Callable, Union
-import uuid
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Callable, Union
+
+if TYPE_CHECKING:
+    from smpy.profiler import Profiler
 
 
 class XyzState(Enum):
@@ -83,6 +85,11 @@ class XyzStateException(Exception):
     pass
 
 
+# How many (data key -> target state) results are remembered for each
+# state, when all its data listeners are pure.
+PURE_DATA_CACHE_SIZE = 1024
+
+
 transition_set: Dict[int, bool] = dict()
 link_map: Dict[XyzState, Dict[str, XyzState]] = dict()
 
@@ -101,16 +108,33 @@ def register_transition(name: Optional[str], from_state: XyzState, to_state: Xyz
     fromMap[name] = to_state
 
 
-# BEGIN_HANDLEBARS
-# {{#each transitions}}
-# register_transition('{{this.name}}', XyzState.{{this.startState}}, XyzState.{{this.endState}})
-# {{/each}}
-register_transition("run", XyzState.DEFAULT, XyzState.RUNNING)
-register_transition(None, XyzState.DEFAULT, XyzState.STOPPED)
-register_transition(None, XyzState.RUNNING, XyzState.DEFAULT)
-register_transition(None, XyzState.RUNNING, XyzState.STOPPED)
-register_transition(None, XyzState.RUNNING, XyzState.RUNNING)
-# END_HANDLEBARS
+_transitions_registered = False
+
+
+def _ensure_transitions_registered() -> None:
+    """
+    Builds the transition tables. This is deferred until the first
+    state machine is created, so importing the module stays cheap.
+    """
+    global _transitions_registered
+
+    if _transitions_registered:
+        return
+
+    # BEGIN_HANDLEBARS
+    # {{#each transitions}}
+    # register_transition('{{this.name}}', XyzState.{{this.startState}}, XyzState.{{this.endState}})
+    # {{/each}}
+    register_transition("run", XyzState.DEFAULT, XyzState.RUNNING)
+    register_transition(None, XyzState.DEFAULT, XyzState.STOPPED)
+    register_transition(None, XyzState.RUNNING, XyzState.DEFAULT)
+    register_transition(None, XyzState.RUNNING, XyzState.STOPPED)
+    register_transition(None, XyzState.RUNNING, XyzState.RUNNING)
+    # END_HANDLEBARS
+
+    # set only after the tables are complete, since other threads can
+    # construct state machines while we're registering.
+    _transitions_registered = True
 
 
 ChangeStateEventListener = Union[
@@ -120,7 +144,12 @@ ChangeStateEventListener = Union[
 
 
 class XyzStateMachine(object):
+    # profiler installed for all the state machines, see `set_global_profiler`
+    _profiler: 'Optional[Profiler]' = None
+
     def __init__(self, initial_state: Optional[XyzState]=None) -> None:
+        _ensure_transitions_registered()
+
         self._transition_listeners: Dict[str, EventListener] = dict()
         self._data_listeners: Dict[str, EventListener] = dict()
         # BEGIN_HANDLEBARS
@@ -178,13 +207,28 @@ class XyzStateMachine(object):
         if targetState == self._currentState:
             return targetState
 
-        state_change_event: XyzStateChangeEvent = XyzStateChangeEvent(self._currentState, targetState, data)
+        previous_name = self._currentState.value if self._currentState else None
+        target_name = targetState.value
 
-        if self._currentState and \
-                not transition_set.get(STATE_INDEX[self._currentState.value] << 14 | STATE_INDEX[targetState.value]):
-            print("No transition exists between %s -> %s." % (self._currentState.value, targetState.value))
+        if previous_name and \
+                not transition_set.get(STATE_INDEX[previous_name] << 14 | STATE_INDEX[target_name]):
+            print("No transition exists between %s -> %s." % (previous_name, target_name))
             return self._currentState
 
+        return self._change_state_checked(targetState, data, previous_name, target_name)
+
+    def _change_state_checked(self,
+                              targetState: XyzState,
+                              data: Any,
+                              previous_name: Optional[str],
+                              target_name: str) -> XyzState:
+        """
+        Changes the state, after the caller checked that the transition into
+        the `targetState` exists. The names are the values of the current
+        and target states.
+        """
+        state_change_event: XyzStateChangeEvent = XyzStateChangeEvent(self._currentState, targetState, data)
+
         if self._current_change_state_event:
             # The previous_state if it's None, is only set when the initial transition happens into
             # the start state. Then only the *AFTER* callbacks are being invoked, not the *BEFORE*,
@@ -206,13 +250,13 @@ class XyzStateMachine(object):
                 ))
 
         self._current_change_state_event = state_change_event
+        transition_listeners = self._transition_listeners if self._profiler is None else \
+            self._profiler.wrap(self._transition_listeners)
 
-        if state_change_event.previous_state:
-            self._transition_listeners[state_change_event.previous_state.value]\
-                .fire(EventType.BEFORE_LEAVE, state_change_event)
+        if previous_name:
+            transition_listeners[previous_name].fire(EventType.BEFORE_LEAVE, state_change_event)
 
-        self._transition_listeners[state_change_event.target_state.value]\
-            .fire(EventType.BEFORE_ENTER, state_change_event)
+        transition_listeners[target_name].fire(EventType.BEFORE_ENTER, state_change_event)
 
         # The event can't be cancelled in the initial state.
         if state_change_event.cancelled:
@@ -222,15 +266,71 @@ class XyzStateMachine(object):
         self._currentState = targetState
         self._current_change_state_event = None
 
-        if state_change_event.previous_state:
-            self._transition_listeners[state_change_event.previous_state.value]\
-                .fire(EventType.AFTER_LEAVE, state_change_event)
+        if previous_name:
+            transition_listeners[previous_name].fire(EventType.AFTER_LEAVE, state_change_event)
 
-        self._transition_listeners[state_change_event.target_state.value]\
-            .fire(EventType.AFTER_ENTER, state_change_event)
+        transition_listeners[target_name].fire(EventType.AFTER_ENTER, state_change_event)
 
         return self._currentState
 
+    def set_profiler(self, profiler: 'Optional[Profiler]') -> None:
+        """
+        Install a profiler only for this state machine. Passing None makes the
+        state machine use again the global profiler, if any.
+
+        :param Profiler profiler:
+        """
+        if profiler is not None:
+            self._profiler = profiler
+        elif '_profiler' in self.__dict__:
+            del self._profiler
+
+    def _deliver_data(self,
+                      state: XyzState,
+                      state_name: str,
+                      data: Any,
+                      target_names: Dict[int, Union[str, bool]]) -> bool:
+        """
+        Sends the data as `send_data` does, for a machine that's expected to
+        be in `state`. Used by the event bus, that delivers to many machines
+        in the same state, and shares with them the `target_names` cache of
+        the transitions out of `state`: by the id() of the target state, its
+        name, or False if there's no transition into it.
+
+        :return: False if the machine isn't in `state`, and the data wasn't sent.
+        """
+        if self._currentState is not state:
+            return False
+
+        data_listeners = self._data_listeners if self._profiler is None else \
+            self._profiler.wrap(self._data_listeners)
+        target_state = data_listeners[state_name].fire_data(data)
+
+        if not target_state or target_state is state:
+            return True
+
+        # a listener already changed the state.
+        if self._currentState is not state:
+            self.changeState(target_state, data)
+            return True
+
+        target_name = target_names.get(id(target_state))
+
+        if target_name is None:
+            target_name = target_state.value
+
+            if not transition_set.get(STATE_INDEX[state_name] << 14 | STATE_INDEX[target_name]):
+                target_name = False
+
+            target_names[id(target_state)] = target_name
+
+        if target_name:
+            self._change_state_checked(target_state, data, state_name, target_name)
+        else:
+            print("No transition exists between %s -> %s." % (state_name, target_state.value))
+
+        return True
+
     def transition(self, link_name: str, data: Any=None) -> XyzState:
         """
         Transition into another state following a named transition.
@@ -305,15 +405,29 @@ class XyzStateMachine(object):
         """
         return self._transition_listeners[state.value].add_listener(EventType.AFTER_LEAVE, callback)
 
-    def on_data(self, state: XyzState, callback: Callable[[Any], Optional[XyzState]]):
+    def on_data(self,
+                state: XyzState,
+                callback: Callable[[Any], Optional[XyzState]],
+                pure: bool=False,
+                key: 'Optional[Callable[[Any], Any]]'=None):
         """
         Add a data listener that will be called when data is being pushed for that transition.
 
+        A `pure` listener only computes the target state from the key of the
+        data, so when all the listeners of a state are pure, the returned
+        state is cached by that key, and the callbacks aren't called again
+        for it.
+
         :param XyzState state:
         :param callback:
+        :param bool pure: The callback has no side effects, and depends only on the key of the data.
+        :param key: Function returning the hashable cache key of the data. Defaults to the data itself.
         :return:
         """
-        return self._data_listeners[state.value].add_listener(EventType.DATA, callback)
+        if key is not None and not pure:
+            raise ValueError("A key can only be used with pure data listeners.")
+
+        return self._data_listeners[state.value].add_listener(EventType.DATA, callback, pure, key)
 
     def forward_data(self, new_state: XyzState, data: Any) -> None:
         """
@@ -341,7 +455,9 @@ class XyzStateMachine(object):
 
         self.changeState(new_state, data)
 
-        target_state = self._data_listeners[self._currentState.value].fire(EventType.DATA, data)
+        data_listeners = self._data_listeners if self._profiler is None else \
+            self._profiler.wrap(self._data_listeners)
+        target_state = data_listeners[self._currentState.value].fire_data(data)
 
         if target_state:
             return self.changeState(target_state, data)
@@ -364,8 +480,9 @@ class XyzStateMachine(object):
         if state:
             self.changeState(state)
 
-        target_state = self._data_listeners[self._currentState.value]\
-            .fire(EventType.DATA, data)
+        data_listeners = self._data_listeners if self._profiler is None else \
+            self._profiler.wrap(self._data_listeners)
+        target_state = data_listeners[self._currentState.value].fire_data(data)
 
         if target_state:
             return self.changeState(target_state, data)
@@ -382,38 +499,116 @@ class EventType(Enum):
 
 
 class EventListenerRegistration(object):
-    def __init__(self, event_listener, callback_id):
+    def __init__(self, event_listener, event_name, callback_id):
         self._event_listener = event_listener
+        self._event_name = event_name
         self._callback_id = callback_id
 
     def detach(self):
-        self._event_listener.eventListeners.pop(self._callback_id)
+        self._event_listener.remove_listener(self._event_name, self._callback_id)
+
+
+_MISSING = object()
 
 
 class EventListener(object):
     def __init__(self):
         self.registered = dict()
-
-    def add_listener(self, event_name, callback):
+        self._next_callback_id = 0
+        # created with the first data listener. `_pure_keys` holds the key
+        # functions of the pure data listeners by callback id, and
+        # `_data_cache` their results in LRU order, oldest first.
+        self._pure_keys: Optional[Dict[int, Callable[[Any], Any]]] = None
+        self._data_cache: Optional[Dict[Any, Any]] = None
+
+    def add_listener(self, event_name, callback, pure=False, key=None):
         event_listeners = self.registered.get(event_name.value)
 
         if not event_listeners:
             event_listeners = self.registered[event_name.value] = dict()
 
-        callback_id = uuid.uuid4()
+        callback_id = self._next_callback_id
+        self._next_callback_id += 1
         event_listeners[callback_id] = callback
 
-        return EventListenerRegistration(self, callback_id)
+        if event_name == EventType.DATA:
+            if self._data_cache is None:
+                self._pure_keys = dict()
+                self._data_cache = dict()
+
+            if pure:
+                self._pure_keys[callback_id] = key or _identity
+
+            self._data_cache.clear()
+
+        return EventListenerRegistration(self, event_name, callback_id)
+
+    def remove_listener(self, event_name, callback_id):
+        event_listeners = self.registered.get(event_name.value)
+
+        if event_listeners:
+            event_listeners.pop(callback_id, None)
+
+        if event_name == EventType.DATA and self._data_cache is not None:
+            self._pure_keys.pop(callback_id, None)
+            self._data_cache.clear()
+
+    def fire_data(self, data, profiler=None, state_name=None):
+        """
+        Fire the data listeners. If all of them are pure, the resulting
+        target state is memoized by the key of the data.
+        """
+        listeners = self.registered.get(EventType.DATA.value)
+
+        if not listeners or len(self._pure_keys) != len(listeners):
+            return self.fire(EventType.DATA, data, profiler=profiler, state_name=state_name)
 
-    def fire(self, event_type, ev):
+        data_cache = self._data_cache
+
+        try:
+            if len(self._pure_keys) == 1:
+                cache_key = next(iter(self._pure_keys.values()))(data)
+            else:
+                cache_key = tuple(key(data) for key in self._pure_keys.values())
+
+            result = data_cache.pop(cache_key, _MISSING)
+        except Exception:
+            # the key can't be computed, or isn't hashable, so the data goes
+            # to the listeners uncached, and they report their own errors.
+            return self.fire(EventType.DATA, data, profiler=profiler, state_name=state_name)
+
+        if result is not _MISSING:
+            data_cache[cache_key] = result  # most recently used
+            return result
+
+        errors: List[Exception] = []
+        result = self.fire(EventType.DATA, data, errors, profiler, state_name)
+
+        # a failed listener returned nothing, and that's not its answer
+        # for this key.
+        if errors:
+            return result
+
+        data_cache[cache_key] = result
+
+        if len(data_cache) > PURE_DATA_CACHE_SIZE:
+            del data_cache[next(iter(data_cache))]
+
+        return result
+
+    def fire(self, event_type, ev, errors=None, profiler=None, state_name=None):
         result = None
 
         if not self.registered.get(event_type.value):
             return
 
         listeners = self.registered[event_type.value]
+        callbacks = listeners.values()
+
+        if profiler is not None:
+            callbacks = profiler.timed(callbacks, state_name, event_type.value)
 
-        for callback in listeners.values():
+        for callback in callbacks:
             try:
                 potential_result = callback.__call__(ev)
 
@@ -423,7 +618,23 @@ class EventListener(object):
                 result = potential_result
             except Exception as e:
                 print(e)
+                if errors is not None:
+                    errors.append(e)
                 if isinstance(e, XyzStateException):
                     raise e
 
         return result
+
+
+def _identity(data: Any) -> Any:
+    return data
+
+
+def set_global_profiler(profiler: 'Optional[Profiler]') -> None:
+    """
+    Install a profiler for all the state machines that don't have their
+    own profiler. Passing None disables the global profiling.
+
+    :param Profiler profiler:
+    """
+    XyzStateMachine._profiler = profiler
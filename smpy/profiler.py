@@ -0,0 +1,188 @@
+from enum import Enum
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+
+class Profiler(object):
+    """
+    Collects the time spent in each phase of the state changes, and in each
+    listener callback. Subclasses can override `record` to send the timings
+    somewhere else.
+
+    The call stack is kept per thread, so the same profiler can be installed
+    globally, and used by state machines running on different threads.
+    """
+
+    def __init__(self) -> None:
+        # (state, event type, listener) -> [calls, total_ns, errors]. The
+        # whole phase is reported under the `*` listener.
+        self.stats: Dict[Tuple[str, str, str], List[int]] = dict()
+        # call stack -> total_ns, including the nested frames
+        self.stacks: Dict[Tuple[str, ...], int] = dict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def enter(self, frame: str) -> None:
+        local = self._local
+
+        if not hasattr(local, 'stack'):
+            local.stack = []
+            local.starts = []
+
+        local.stack.append(frame)
+        local.starts.append(time.perf_counter_ns())
+
+    def leave(self, key: Tuple[str, str, str], error: Optional[BaseException]=None) -> None:
+        local = self._local
+        duration_ns = time.perf_counter_ns() - local.starts.pop()
+
+        try:
+            self.record(key, tuple(local.stack), duration_ns, error)
+        finally:
+            local.stack.pop()
+
+    def wrap(self, event_listeners: Dict[str, Any]) -> '_ProfiledEventListeners':
+        """
+        The event listeners of a state machine by state name, firing their
+        callbacks through this profiler.
+        """
+        return _ProfiledEventListeners(self, event_listeners)
+
+    def timed(self, callbacks: Iterable[Callable], state_name: str, event_name: str) -> List[Callable]:
+        """
+        Wraps the callbacks of an event, so each call is timed.
+        """
+        return [_TimedCallback(self, callback, (state_name, event_name, self.listener_name(callback)))
+                for callback in callbacks]
+
+    def listener_name(self, callback: Any) -> str:
+        name = getattr(callback, '__qualname__', None)
+
+        if name is None:
+            name = type(callback).__qualname__
+
+        return "%s.%s" % (getattr(callback, '__module__', None) or '?', name)
+
+    def record(self,
+               key: Tuple[str, str, str],
+               stack: Tuple[str, ...],
+               duration_ns: int,
+               error: Optional[BaseException]) -> None:
+        """
+        Called when a phase, or a listener callback, ends.
+
+        :param tuple key: The (state, event type, listener) that was timed.
+        :param tuple stack: The frames that are currently running in this thread, the timed one being last.
+        :param int duration_ns:
+        :param Exception error: The exception raised by the listener, if any.
+        """
+        with self._lock:
+            stats = self.stats.get(key)
+
+            if stats is None:
+                stats = self.stats[key] = [0, 0, 0]
+
+            stats[0] += 1
+            stats[1] += duration_ns
+
+            if error is not None:
+                stats[2] += 1
+
+            self.stacks[stack] = self.stacks.get(stack, 0) + duration_ns
+
+    def clear(self) -> None:
+        with self._lock:
+            self.stats.clear()
+            self.stacks.clear()
+
+    def report(self) -> str:
+        """
+        The timings per (state, event type, listener), the slowest first.
+        """
+        with self._lock:
+            all_stats = [(key, list(stats)) for key, stats in self.stats.items()]
+
+        lines = ["%-12s %-14s %-50s %8s %12s %10s %6s" % (
+            "state", "event", "listener", "calls", "total_us", "avg_us", "errors")]
+
+        for key, stats in sorted(all_stats, key=lambda item: -item[1][1]):
+            lines.append("%-12s %-14s %-50s %8d %12.1f %10.2f %6d" % (
+                key[0], key[1], key[2], stats[0], stats[1] / 1000, stats[1] / stats[0] / 1000, stats[2]))
+
+        return "\n".join(lines)
+
+    def collapsed_stacks(self) -> str:
+        """
+        The timings in the collapsed stack format used by flamegraph.pl, with
+        the self time of each stack in nanoseconds.
+        """
+        with self._lock:
+            stacks = dict(self.stacks)
+
+        self_times = dict(stacks)
+
+        for stack, duration_ns in stacks.items():
+            parent = stack[:-1]
+
+            if parent in self_times:
+                self_times[parent] -= duration_ns
+
+        return "\n".join("%s %d" % (";".join(stack), max(duration_ns, 0))
+                         for stack, duration_ns in sorted(self_times.items()))
+
+
+class _TimedCallback(object):
+    def __init__(self, profiler: Profiler, callback: Callable, key: Tuple[str, str, str]) -> None:
+        self._profiler = profiler
+        self._callback = callback
+        self._key = key
+
+    def __call__(self, ev: Any) -> Any:
+        error = None
+        self._profiler.enter(self._key[2])
+
+        try:
+            return self._callback(ev)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._profiler.leave(self._key, error)
+
+
+class _ProfiledEventListeners(object):
+    def __init__(self, profiler: Profiler, event_listeners: Dict[str, Any]) -> None:
+        self._profiler = profiler
+        self._event_listeners = event_listeners
+
+    def __getitem__(self, state_name: str) -> '_ProfiledEventListener':
+        return _ProfiledEventListener(self._profiler, self._event_listeners[state_name], state_name)
+
+
+class _ProfiledEventListener(object):
+    """
+    Fires the events of an EventListener, timing the whole phase, and
+    each one of its callbacks.
+    """
+
+    def __init__(self, profiler: Profiler, event_listener: Any, state_name: str) -> None:
+        self._profiler = profiler
+        self._event_listener = event_listener
+        self._state_name = state_name
+
+    def fire(self, event_type: Enum, ev: Any) -> Any:
+        self._profiler.enter("%s %s" % (event_type.value, self._state_name))
+
+        try:
+            return self._event_listener.fire(event_type, ev, profiler=self._profiler, state_name=self._state_name)
+        finally:
+            self._profiler.leave((self._state_name, event_type.value, "*"))
+
+    def fire_data(self, data: Any) -> Any:
+        self._profiler.enter("data %s" % self._state_name)
+
+        try:
+            return self._event_listener.fire_data(data, self._profiler, self._state_name)
+        finally:
+            self._profiler.leave((self._state_name, "data", "*"))
@@ -1,6 +1,12 @@
+import subprocess
+import sys
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 
-from smpy.XyzStateMachine import XyzStateMachine, XyzState, XyzStateChangeEvent
+from smpy.XyzStateMachine import XyzStateMachine, XyzState, XyzStateChangeEvent, set_global_profiler
+from smpy.event_bus import EventBus
+from smpy.profiler import Profiler
 
 
 class TestXyzStateMachine(unittest.TestCase):
@@ -236,6 +242,376 @@ class TestXyzStateMachine(unittest.TestCase):
         self.assertEqual(6, self.expected)
         self.assertEqual(XyzState.STOPPED, self.stateMachine.state)
 
+    def test_import_is_lazy(self):
+        code = ("import sys\n"
+                "import smpy.XyzStateMachine as m\n"
+                "assert 'uuid' not in sys.modules\n"
+                "assert not m.transition_set\n"
+                "m.XyzStateMachine()\n"
+                "assert m.transition_set\n")
+
+        subprocess.run([sys.executable, "-c", code], check=True)
+
+    def test_event_bus_fan_out(self):
+        event_bus = EventBus(batch_size=3)
+        self.data = []
+
+        def on_running_data(data):
+            self.data.append(data)
+            return XyzState.STOPPED
+
+        state_machines = []
+
+        for i in range(10):
+            stateMachine = XyzStateMachine(XyzState.RUNNING if i % 2 else XyzState.DEFAULT)
+            stateMachine.on_data(XyzState.RUNNING, on_running_data)
+            event_bus.subscribe("drain", stateMachine)
+            state_machines.append(stateMachine)
+
+        self.assertEqual(10, event_bus.publish("drain", "x"))
+        self.assertEqual(["x"] * 5, self.data)
+        self.assertEqual([XyzState.DEFAULT, XyzState.STOPPED] * 5,
+                         [stateMachine.state for stateMachine in state_machines])
+        self.assertEqual(0, event_bus.publish("missing"))
+
+    def test_event_bus_state_filter_and_detach(self):
+        event_bus = EventBus()
+        self.expected = 0
+
+        def on_data(data):
+            self.expected += data
+
+        stateMachine = XyzStateMachine()
+        stateMachine.on_data(XyzState.DEFAULT, on_data)
+        stateMachine.on_data(XyzState.RUNNING, on_data)
+
+        event_bus.subscribe("topic", stateMachine, XyzState.RUNNING)
+        registration = event_bus.subscribe("topic", stateMachine)
+
+        self.assertEqual(1, event_bus.publish("topic", 1))
+        stateMachine.run()
+        self.assertEqual(2, event_bus.publish("topic", 2))
+        self.assertEqual(5, self.expected)
+
+        registration.detach()
+        self.assertEqual(1, event_bus.publish("topic", 3))
+        self.assertEqual(8, self.expected)
+
+    def test_event_bus_invalid_target_is_ignored(self):
+        event_bus = EventBus()
+        stateMachine = XyzStateMachine(XyzState.STOPPED)
+        stateMachine.on_data(XyzState.STOPPED, lambda data: XyzState.RUNNING)
+        event_bus.subscribe("topic", stateMachine)
+
+        event_bus.publish("topic")
+        self.assertEqual(XyzState.STOPPED, stateMachine.state)
+
+    def test_event_bus_executor(self):
+        state_machines = [XyzStateMachine() for i in range(100)]
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            event_bus = EventBus(batch_size=10, executor=executor)
+
+            for stateMachine in state_machines:
+                stateMachine.on_data(XyzState.DEFAULT, lambda data: XyzState.RUNNING)
+                event_bus.subscribe("topic", stateMachine)
+
+            self.assertEqual(100, event_bus.publish("topic"))
+
+        self.assertTrue(all(stateMachine.state == XyzState.RUNNING for stateMachine in state_machines))
+
+    def test_event_bus_state_filter_after_listener_change(self):
+        event_bus = EventBus()
+        self.data = []
+
+        a = XyzStateMachine(XyzState.RUNNING)
+        b = XyzStateMachine(XyzState.RUNNING)
+
+        def on_a_running_data(data):
+            b.changeState(XyzState.DEFAULT)
+
+        a.on_data(XyzState.RUNNING, on_a_running_data)
+        b.on_data(XyzState.DEFAULT, lambda data: self.data.append(data))
+
+        event_bus.subscribe("topic", a, XyzState.RUNNING)
+        event_bus.subscribe("topic", b, XyzState.RUNNING)
+
+        self.assertEqual(1, event_bus.publish("topic", "x"))
+        self.assertEqual([], self.data)
+
+    def test_event_bus_delivers_a_machine_on_a_single_thread(self):
+        stateMachine = XyzStateMachine()
+        self.running = 0
+        self.overlaps = 0
+
+        def on_data(data):
+            self.running += 1
+
+            if self.running > 1:
+                self.overlaps += 1
+
+            time.sleep(0.01)
+            self.running -= 1
+
+        stateMachine.on_data(XyzState.DEFAULT, on_data)
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            event_bus = EventBus(batch_size=1, executor=executor)
+
+            for i in range(4):
+                event_bus.subscribe("topic", stateMachine)
+
+            self.assertEqual(4, event_bus.publish("topic"))
+
+        self.assertEqual(0, self.overlaps)
+
+    def test_event_bus_waits_for_all_the_batches(self):
+        failing = XyzStateMachine()
+        failing.on_data(XyzState.DEFAULT, lambda data: XyzState.RUNNING)
+        failing.on_data(XyzState.DEFAULT, lambda data: XyzState.STOPPED)
+
+        slow = XyzStateMachine()
+        self.expected = 0
+
+        def on_slow_data(data):
+            time.sleep(0.05)
+            self.expected = 1
+
+        slow.on_data(XyzState.DEFAULT, on_slow_data)
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            event_bus = EventBus(batch_size=1, executor=executor)
+            event_bus.subscribe("topic", failing)
+            event_bus.subscribe("topic", slow)
+
+            with self.assertRaises(Exception):
+                event_bus.publish("topic")
+
+            self.assertEqual(1, self.expected)
+
+    def test_pure_data_listeners_are_cached(self):
+        stateMachine = XyzStateMachine()
+        self.expected = 0
+
+        def on_default_data(data):
+            self.expected += 1
+            return XyzState.RUNNING if data["command"] == "run" else None
+
+        stateMachine.on_data(XyzState.DEFAULT, on_default_data,
+                             pure=True, key=lambda data: data["command"])
+
+        stateMachine.send_data({"command": "noop"})
+        stateMachine.send_data({"command": "noop", "id": 2})
+        self.assertEqual(1, self.expected)
+
+        stateMachine.send_data({"command": "run"})
+        self.assertEqual(XyzState.RUNNING, stateMachine.state)
+        stateMachine.changeState(XyzState.DEFAULT)
+        stateMachine.send_data({"command": "run"})
+        self.assertEqual(XyzState.RUNNING, stateMachine.state)
+        self.assertEqual(2, self.expected)
+
+    def test_pure_data_cache_is_invalidated(self):
+        stateMachine = XyzStateMachine()
+        self.expected = 0
+
+        def on_data(data):
+            self.expected += 1
+
+        registration = stateMachine.on_data(XyzState.DEFAULT, on_data, pure=True)
+        stateMachine.send_data(1)
+        stateMachine.send_data(1)
+        self.assertEqual(1, self.expected)
+
+        registration.detach()
+        stateMachine.on_data(XyzState.DEFAULT, lambda data: XyzState.RUNNING, pure=True)
+        self.assertEqual(XyzState.RUNNING, stateMachine.send_data(1))
+        self.assertEqual(1, self.expected)
+
+    def test_impure_data_listeners_are_not_cached(self):
+        stateMachine = XyzStateMachine()
+        self.expected = 0
+
+        def on_data(data):
+            self.expected += 1
+
+        stateMachine.on_data(XyzState.DEFAULT, lambda data: None, pure=True)
+        stateMachine.on_data(XyzState.DEFAULT, on_data)
+        stateMachine.send_data(1)
+        stateMachine.send_data(1)
+        stateMachine.send_data([1])
+
+        self.assertEqual(3, self.expected)
+
+    def test_pure_data_listener_key_errors_are_not_raised(self):
+        stateMachine = XyzStateMachine()
+        self.expected = 0
+
+        def on_data(data):
+            self.expected += 1
+            return XyzState.RUNNING if data.get("command") == "run" else None
+
+        stateMachine.on_data(XyzState.DEFAULT, on_data, pure=True, key=lambda data: data["command"])
+
+        self.assertEqual(XyzState.DEFAULT, stateMachine.send_data({}))
+        self.assertEqual(XyzState.DEFAULT, stateMachine.send_data({}))
+        self.assertEqual(2, self.expected)
+        self.assertEqual(XyzState.RUNNING, stateMachine.send_data({"command": "run"}))
+
+        with self.assertRaises(ValueError):
+            stateMachine.on_data(XyzState.RUNNING, on_data, key=lambda data: data["command"])
+
+    def test_failed_pure_data_listeners_are_not_cached(self):
+        stateMachine = XyzStateMachine()
+        self.expected = 0
+
+        def on_data(data):
+            self.expected += 1
+
+            if self.expected == 1:
+                raise Exception("test error")
+
+            return XyzState.RUNNING
+
+        stateMachine.on_data(XyzState.DEFAULT, on_data, pure=True)
+
+        self.assertEqual(XyzState.DEFAULT, stateMachine.send_data("k"))
+        self.assertEqual(XyzState.RUNNING, stateMachine.send_data("k"))
+        self.assertEqual(2, self.expected)
+
+    def test_profiler(self):
+        stateMachine = XyzStateMachine()
+        profiler = Profiler()
+        stateMachine.set_profiler(profiler)
+
+        def before_enter(ev):
+            pass
+
+        def after_enter(ev):
+            raise Exception("test error")
+
+        def on_running_data(data):
+            return XyzState.DEFAULT
+
+        stateMachine.before_enter(XyzState.RUNNING, before_enter)
+        stateMachine.after_enter(XyzState.RUNNING, after_enter)
+        stateMachine.on_data(XyzState.RUNNING, on_running_data)
+
+        stateMachine.run()
+        stateMachine.send_data("x")
+        self.assertEqual(XyzState.DEFAULT, stateMachine.state)
+
+        prefix = __name__ + "." + type(self).__qualname__ + ".test_profiler.<locals>."
+        self.assertEqual([1, 0], profiler.stats[("RUNNING", "before-enter", prefix + "before_enter")][::2])
+        self.assertEqual([1, 1], profiler.stats[("RUNNING", "after-enter", prefix + "after_enter")][::2])
+        self.assertEqual(1, profiler.stats[("RUNNING", "data", "*")][0])
+        self.assertEqual(1, profiler.stats[("DEFAULT", "before-leave", "*")][0])
+        self.assertIn(prefix + "on_running_data", profiler.report())
+
+        collapsed = profiler.collapsed_stacks().split("\n")
+        self.assertIn("data RUNNING;" + prefix + "on_running_data", [line.rsplit(" ", 1)[0] for line in collapsed])
+        self.assertTrue(all(int(line.rsplit(" ", 1)[1]) >= 0 for line in collapsed))
+
+        stateMachine.set_profiler(None)
+        profiler.clear()
+        stateMachine.changeState(XyzState.RUNNING)
+        self.assertEqual(XyzState.RUNNING, stateMachine.state)
+        self.assertEqual({}, profiler.stats)
+
+    def test_global_profiler(self):
+        profiler = Profiler()
+        set_global_profiler(profiler)
+
+        try:
+            stateMachine = XyzStateMachine()
+            stateMachine.run()
+        finally:
+            set_global_profiler(None)
+
+        self.assertEqual(1, profiler.stats[("RUNNING", "after-enter", "*")][0])
+        stateMachine.changeState(XyzState.STOPPED)
+        self.assertNotIn(("STOPPED", "after-enter", "*"), profiler.stats)
+
+    def test_global_profiler_with_event_bus_executor(self):
+        profiler = Profiler()
+        set_global_profiler(profiler)
+
+        def on_default_data(data):
+            time.sleep(0.0001)
+            return XyzState.RUNNING
+
+        try:
+            state_machines = [XyzStateMachine() for i in range(400)]
+
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                event_bus = EventBus(batch_size=10, executor=executor)
+
+                for stateMachine in state_machines:
+                    stateMachine.on_data(XyzState.DEFAULT, on_default_data)
+                    event_bus.subscribe("topic", stateMachine)
+
+                self.assertEqual(400, event_bus.publish("topic"))
+        finally:
+            set_global_profiler(None)
+
+        listener_name = profiler.listener_name(on_default_data)
+        data_stats = profiler.stats[("DEFAULT", "data", "*")]
+        listener_stats = profiler.stats[("DEFAULT", "data", listener_name)]
+
+        self.assertEqual(400, data_stats[0])
+        self.assertEqual(400, listener_stats[0])
+        self.assertGreaterEqual(data_stats[1], listener_stats[1])
+        self.assertEqual({("data DEFAULT", listener_name)},
+                         {stack for stack in profiler.stacks if len(stack) > 1})
+
+    def test_profiler_record_errors_keep_the_stack(self):
+        class FailingProfiler(Profiler):
+            def record(self, key, stack, duration_ns, error):
+                Profiler.record(self, key, stack, duration_ns, error)
+
+                if key[2] == "*":
+                    raise Exception("test error")
+
+        profiler = FailingProfiler()
+        stateMachine = XyzStateMachine()
+        self.assertEqual(XyzState.DEFAULT, stateMachine.state)
+        stateMachine.set_profiler(profiler)
+        stateMachine.on_data(XyzState.DEFAULT, lambda data: None)
+
+        for i in range(2):
+            with self.assertRaises(Exception):
+                stateMachine.send_data(i)
+
+        self.assertEqual({("data DEFAULT",), ("data DEFAULT", profiler.listener_name(lambda data: None))},
+                         set(profiler.stacks))
+
+    def test_profiler_report_while_recording(self):
+        profiler = Profiler()
+        state_machines = []
+
+        for i in range(200):
+            stateMachine = XyzStateMachine()
+            stateMachine.set_profiler(profiler)
+            # a different listener for each machine, so new keys keep being added
+            listener_type = type("Listener%d" % i, (), {"__call__": lambda self, data: None})
+            stateMachine.on_data(XyzState.DEFAULT, listener_type())
+            state_machines.append(stateMachine)
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            event_bus = EventBus(batch_size=1, executor=executor)
+
+            for stateMachine in state_machines:
+                event_bus.subscribe("topic", stateMachine)
+
+            future = executor.submit(event_bus.publish, "topic")
+
+            while not future.done():
+                profiler.report()
+                profiler.collapsed_stacks()
+
+            self.assertEqual(200, future.result())
+
+
 
 if __name__ == '__main__':
     unittest.main()